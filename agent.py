@@ -1,12 +1,18 @@
 import asyncio
 import json
-import sys
 import os
 import re
-from typing import Dict, Any, List
+import hashlib
+import time
+from typing import Dict, Any, AsyncIterator, Callable, Deque, List, Optional, Tuple
+from collections import OrderedDict, deque
 from contextlib import AsyncExitStack
 
-from cerebras.cloud.sdk import Cerebras
+import anyio
+import orjson
+
+import httpx
+from cerebras.cloud.sdk import AsyncCerebras, BadRequestError
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
@@ -16,12 +22,39 @@ from config import (
     CEREBRAS_API_KEY,
     MODEL,
     TEMPERATURE,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY,
+    LLM_CONNECT_TIMEOUT,
+    LLM_READ_TIMEOUT,
     COMPRESSION_TEMPERATURE,
     MAX_STEPS,
     MAX_PROMPT_CHARS,
     MAX_COMPRESSION_TOKENS,
+    COMPRESSION_TIMEOUT,
+    MAX_TOOL_PAYLOAD_CHARS,
+    MAX_TOOL_FIELD_CHARS,
+    MAX_HISTORY_CHARS,
+    TRIMMED_RESULT_CHARS,
+    PLANNER_MODE,
+    DIRECT_INTENTS_ENABLED,
+    DIRECT_INTENT_MAX_CHARS,
     SERVER_PATH,
     SERVER_COMMAND,
+    SESSION_PING_TIMEOUT,
+    TOOL_CALL_TIMEOUT,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    LLM_CACHE_SIZE,
+    LLM_CACHE_TTL,
+    TOOL_CACHE_SIZE,
+    TOOL_CACHE_TTL,
+    GEOCODING_CACHE_TTL,
+    BOOKS_CACHE_TTL,
+    CACHEABLE_TOOLS,
+    PREF_FILE,
+    PREFS_FLUSH_INTERVAL,
+    DETECTED_GENRES,
     validate_config,
     load_system_prompt
 )
@@ -29,32 +62,87 @@ from config import (
 # Validate configuration on startup
 validate_config()
 
-cerebras_client = Cerebras(api_key=CEREBRAS_API_KEY)
+# One async client for the whole process so every LLM call shares the same
+# keep-alive HTTP/2 connection pool.
+cerebras_client = AsyncCerebras(
+    api_key=CEREBRAS_API_KEY,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=LLM_MAX_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    ),
+)
+
+# Receives short human-readable status updates while the agent works
+ProgressCallback = Callable[[str], None]
 
 # Load system prompt from configuration
 SYSTEM = load_system_prompt()
 
+# Patterns used on every user message, compiled once
+_COORD_RE = re.compile(r"\(?(-?\d{1,3}\.\d+)\s*,\s*(-?\d{1,3}\.\d+)\)?")
+# Longest first so "science fiction" wins over any shorter overlapping genre
+_GENRE_RE = re.compile(
+    r"\b(" + "|".join(re.escape(g) for g in sorted(DETECTED_GENRES, key=lambda g: (-len(g), g))) + r")\b",
+    re.I,
+) if DETECTED_GENRES else None
+
+def _dumps(obj: Any) -> str:
+    """Serialize to a JSON str (orjson emits bytes)."""
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bits; stdlib json handles what orjson rejects
+        return json.dumps(obj, default=str)
+
+# Shared helpers for the in-process caches below: each is an OrderedDict used
+# as an LRU of key -> (stored_at, value), with entries expiring after a TTL.
+def _ttl_get(cache: OrderedDict, key: Any, ttl: float) -> Any:
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    stored_at, value = entry
+    if time.monotonic() - stored_at > ttl:
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return value
+
+def _ttl_put(cache: OrderedDict, key: Any, value: Any, max_size: int) -> None:
+    cache[key] = (time.monotonic(), value)
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
 # -----------------------------
 # Large prompt compression
 # -----------------------------
-def compress_large_input(user_message: str) -> str:
+async def compress_large_input(user_message: str) -> str:
     if len(user_message) <= MAX_PROMPT_CHARS:
         return user_message
 
     try:
-        response = cerebras_client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Extract only the actionable request:\n{user_message[:MAX_PROMPT_CHARS]}"
-                }
-            ],
-            temperature=COMPRESSION_TEMPERATURE,
-            max_tokens=MAX_COMPRESSION_TOKENS,
+        response = await asyncio.wait_for(
+            cerebras_client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": f"Extract only the actionable request:\n{user_message[:MAX_PROMPT_CHARS]}"
+                    }
+                ],
+                temperature=COMPRESSION_TEMPERATURE,
+                max_tokens=MAX_COMPRESSION_TOKENS,
+            ),
+            timeout=COMPRESSION_TIMEOUT,
         )
         return response.choices[0].message.content.strip()
     except Exception:
+        # Includes the timeout: plain truncation beats waiting on the LLM
         return user_message[:MAX_PROMPT_CHARS]
 
 # -----------------------------
@@ -63,195 +151,901 @@ def compress_large_input(user_message: str) -> str:
 def normalize_tool_result(result) -> str:
     """Extract JSON data from MCP tool result."""
     try:
-        # Try .json() method first
+        # MCP results already carry the tool's JSON as text; pass it through
+        # instead of re-serializing.
+        content = getattr(result, 'content', None)
+        if content:
+            return getattr(content[0], 'text', None) or "{}"
+        # Try .json() method
         if hasattr(result, 'json') and callable(result.json):
-            return json.dumps(result.json())
+            return _dumps(result.json())
         # Try .json attribute
         if hasattr(result, 'json') and not callable(result.json):
-            return json.dumps(result.json)
-        # Try content[0].text
-        if hasattr(result, 'content') and result.content:
-            return result.content[0].text if result.content[0].text else "{}"
+            return _dumps(result.json)
         # Fallback: try to convert to string
         return str(result)
     except Exception:
         return "{}"
 
+def _shorten_fields(obj: Any, limit: int) -> Any:
+    """Cut every string longer than `limit`, keeping the structure intact."""
+    if isinstance(obj, str):
+        return obj if len(obj) <= limit else obj[:limit] + "…"
+    if isinstance(obj, dict):
+        return {k: _shorten_fields(v, limit) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_shorten_fields(v, limit) for v in obj]
+    return obj
+
+def compact_tool_payload(payload: str) -> str:
+    """Shrink a tool payload before it is added to the LLM history.
+
+    Inline base64 images are replaced with a short placeholder. Payloads
+    over MAX_TOOL_PAYLOAD_CHARS have their long string fields (e.g. book
+    descriptions) shortened, so every item survives and the JSON stays valid.
+    """
+    has_image = '"image_base64"' in payload
+    if not has_image and len(payload) <= MAX_TOOL_PAYLOAD_CHARS:
+        return payload
+    try:
+        data = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return payload
+    if has_image and isinstance(data, dict) and isinstance(data.get("image_base64"), str):
+        size_kb = len(data["image_base64"]) * 3 // 4 // 1024
+        data["image_base64"] = f"<image received, {size_kb}KB>"
+    payload = _dumps(data)
+    if len(payload) > MAX_TOOL_PAYLOAD_CHARS:
+        payload = _dumps(_shorten_fields(data, MAX_TOOL_FIELD_CHARS))
+    return payload
+
 # -----------------------------
 # LLM JSON helper (Cerebras)
 # -----------------------------
-def llm_json(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+# Flipped off if the provider rejects json_schema requests; json_object is
+# used from then on.
+_json_schema_supported = True
+
+# Exact-match cache of parsed LLM replies, keyed on a hash of the full
+# message list and stored as (stored_at, decision). Only successful parses
+# are stored.
+_llm_cache: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def _has_tool_result(messages: List[Dict[str, str]]) -> bool:
+    return any(
+        m["role"] == "user" and "Tool '" in m["content"] and "' returned: " in m["content"]
+        for m in messages
+    )
+
+def build_step_schema(tool_names) -> Dict[str, Any]:
+    """JSON schema for one agent step, restricted to the known tool names."""
+    names = sorted(tool_names)
+    return {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": ["final", "parallel", *names]},
+            "answer": {"type": "string"},
+            "args": {"type": "object"},
+            "calls": {"type": "array", "items": _tool_call_schema(names)},
+        },
+        "required": ["action"],
+    }
+
+def build_plan_schema(tool_names) -> Dict[str, Any]:
+    """JSON schema for the up-front tool plan."""
+    return {
+        "type": "object",
+        "properties": {
+            "plan": {"type": "array", "items": _tool_call_schema(sorted(tool_names))},
+            "dependent": {"type": "boolean"},
+        },
+        "required": ["plan", "dependent"],
+    }
+
+# Used when the answer must be forced: tool actions are not allowed at all
+FINAL_STEP_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": ["final"]},
+        "answer": {"type": "string"},
+    },
+    "required": ["action", "answer"],
+}
+
+def _tool_call_schema(names: List[str]) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "enum": names},
+            "args": {"type": "object"},
+        },
+        "required": ["name"],
+    }
+
+def coerce_step(data: Any) -> Optional[Dict[str, Any]]:
+    """Validate a decoded LLM reply once so callers can trust its field types.
+
+    Accepts a JSON object (or a list wrapping one) and normalizes "args" to a
+    dict and "answer" to a string. Returns None for anything else.
+    """
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    if not isinstance(data, dict):
+        return None
+    if not isinstance(data.get("args", {}), dict):
+        data["args"] = {}
+    if "answer" in data and not isinstance(data["answer"], str):
+        data["answer"] = _dumps(data["answer"])
+    return data
+
+def _response_format(schema: Optional[Dict[str, Any]], name: str) -> Dict[str, Any]:
+    if schema is None or not _json_schema_supported:
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        # Not strict: tool args are open objects, which strict mode rejects
+        "json_schema": {"name": name, "schema": schema},
+    }
+
+def _is_schema_rejection(error: BadRequestError) -> bool:
+    """True if a 400 is about response_format itself (not e.g. context length)."""
+    text = f"{getattr(error, 'message', '')} {getattr(error, 'body', '')}".lower()
+    return "response_format" in text or "json_schema" in text or "schema" in text
+
+def _error_reply(answer: str) -> Dict[str, Any]:
+    """Final decision used when the LLM call fails; marked so it is never cached."""
+    return {"action": "final", "answer": answer, "degraded": True}
+
+async def llm_json(
+    messages: List[Dict[str, str]],
+    schema: Optional[Dict[str, Any]] = None,
+    schema_name: str = "agent_step",
+) -> Dict[str, Any]:
+    global _json_schema_supported
+    cache_key = hashlib.blake2b(
+        orjson.dumps([schema_name if schema is not None else None, messages]),
+        digest_size=16,
+    ).digest()
+    cached = _ttl_get(_llm_cache, cache_key, LLM_CACHE_TTL)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        response = cerebras_client.chat.completions.create(
+        response = await cerebras_client.chat.completions.create(
             model=MODEL,
             messages=messages,
             temperature=TEMPERATURE,
-            response_format={"type": "json_object"},
+            response_format=_response_format(schema, schema_name),
         )
         content = response.choices[0].message.content
         if content is None:
             print("[DEBUG] LLM returned None content")
             print(f"[DEBUG] Response: {response}")
-            return {"action": "final", "answer": "I apologize, but I encountered an issue processing your request."}
+            return _error_reply("I apologize, but I encountered an issue processing your request.")
         
         # Try to parse JSON
         try:
-            return json.loads(content)
-        except json.JSONDecodeError as je:
+            decision = coerce_step(orjson.loads(content))
+        except orjson.JSONDecodeError as je:
             print(f"[DEBUG] JSON decode error: {je}")
             print(f"[DEBUG] Content was: {content}")
-            return {"action": "final", "answer": "I apologize, but I encountered an issue processing your request."}
+            return _error_reply("I apologize, but I encountered an issue processing your request.")
+        if decision is None:
+            print(f"[DEBUG] LLM returned non-object JSON: {content}")
+            return _error_reply("I apologize, but I encountered an issue processing your request.")
+        # A final answer with no tool data behind it (jokes, small talk) should
+        # vary between requests; store_cached_response skips them for the same reason.
+        if decision.get("action") != "final" or _has_tool_result(messages):
+            _ttl_put(_llm_cache, cache_key, dict(decision), LLM_CACHE_SIZE)
+        return decision
+    except BadRequestError as e:
+        if schema is not None and _json_schema_supported and _is_schema_rejection(e):
+            print(f"[DEBUG] json_schema rejected, falling back to json_object: {e}")
+            _json_schema_supported = False
+            return await llm_json(messages)
+        print(f"[DEBUG] LLM call exception: {e}")
+        return _error_reply(f"I apologize, but I encountered an error: {str(e)}")
     except Exception as e:
         print(f"[DEBUG] LLM call exception: {e}")
-        return {"action": "final", "answer": f"I apologize, but I encountered an error: {str(e)}"}
+        return _error_reply(f"I apologize, but I encountered an error: {str(e)}")
+
+# -----------------------------
+# User preferences
+# -----------------------------
+def _read_prefs_file() -> Dict[str, Any]:
+    if not os.path.exists(PREF_FILE):
+        return {}
+    try:
+        with open(PREF_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+def _write_prefs_file(prefs: Dict[str, Any]) -> None:
+    # Write-then-rename so a crash mid-write never leaves a truncated file
+    tmp_path = f"{PREF_FILE}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(prefs, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, PREF_FILE)
+
+# Preferences are read from disk once; afterwards the in-memory copy is the
+# source of truth and writes are flushed in the background.
+_PREFS_CACHE: Dict[str, Any] = _read_prefs_file()
+_PREFS_LOCK = asyncio.Lock()
+_prefs_flush_pending = False
+_last_prefs_flush = 0.0
+_background_tasks: set = set()
+
+async def _flush_prefs() -> None:
+    global _prefs_flush_pending, _last_prefs_flush
+    # Debounce: coalesce saves that arrive within PREFS_FLUSH_INTERVAL
+    delay = PREFS_FLUSH_INTERVAL - (time.monotonic() - _last_prefs_flush)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    _prefs_flush_pending = False
+    async with _PREFS_LOCK:
+        try:
+            await asyncio.to_thread(_write_prefs_file, dict(_PREFS_CACHE))
+        except OSError as e:
+            print(f"[DEBUG] Failed to save preferences: {e}")
+        _last_prefs_flush = time.monotonic()
+
+def _schedule_prefs_flush() -> None:
+    global _prefs_flush_pending
+    if _prefs_flush_pending:
+        return
+    _prefs_flush_pending = True
+    task = asyncio.create_task(_flush_prefs())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def get_pref(key: str, default: Any = None) -> Any:
+    return _PREFS_CACHE.get(key, default)
+
+def set_pref(key: str, value: Any) -> None:
+    """Update one preference in memory; the file write is only scheduled when it changes."""
+    if _PREFS_CACHE.get(key) == value:
+        return
+    _PREFS_CACHE[key] = value
+    _schedule_prefs_flush()
+
+def extract_genre(text: str) -> Optional[str]:
+    """Return the first configured genre mentioned in the message (one regex scan)."""
+    m = _GENRE_RE.search(text) if _GENRE_RE else None
+    return m.group(1).lower() if m else None
+
+# -----------------------------
+# Response cache
+# -----------------------------
+# Maps a normalized user message to (stored_at, result). Only answers built
+# from idempotent tools are stored, so repeat questions skip the LLM entirely.
+_response_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def parse_coords(text: str) -> Optional[Tuple[float, float]]:
+    """Return (latitude, longitude) if the message carries coordinates."""
+    m = _COORD_RE.search(text)
+    if m is None:
+        return None
+    lat, lon = float(m.group(1)), float(m.group(2))
+    if abs(lat) > 90 or abs(lon) > 180:
+        return None
+    return lat, lon
+
+def _cache_key(user_message: str) -> str:
+    """Normalize case, punctuation and whitespace so trivial rephrasings match."""
+    return " ".join(re.findall(r"\w+", user_message.lower()))
+
+def get_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    result = _ttl_get(_response_cache, key, RESPONSE_CACHE_TTL)
+    if result is None:
+        return None
+    return {**result, "tools_used": list(result["tools_used"])}
+
+def store_cached_response(key: str, result: Dict[str, Any]) -> None:
+    tools_used = result.get("tools_used", [])
+    # Skip degraded answers (LLM errors, tool errors, fallback answers), answers
+    # that did not use tools (small talk), and answers that depend on
+    # non-idempotent tools like weather, dog images or trivia.
+    if result.get("degraded") or not result.get("answer") or not tools_used:
+        return
+    if any(tool not in CACHEABLE_TOOLS for tool in tools_used):
+        return
+    _ttl_put(
+        _response_cache, key, {**result, "tools_used": list(tools_used)}, RESPONSE_CACHE_SIZE
+    )
+
+# -----------------------------
+# Persistent MCP session
+# -----------------------------
+def format_tool_description(tool) -> str:
+    """Render one MCP tool as a compact `name(args): summary` line for the LLM."""
+    args = []
+    schema = getattr(tool, 'inputSchema', None) or {}
+    for prop_name, prop_info in schema.get('properties', {}).items():
+        arg_desc = prop_name
+        if isinstance(prop_info, dict) and 'description' in prop_info:
+            arg_desc += f" ({prop_info['description']})"
+        args.append(arg_desc)
+    tool_info = f"{tool.name}({', '.join(args)})"
+    if tool.description:
+        # First line only; multi-line docstrings add tokens without routing value
+        tool_info += f": {tool.description.strip().splitlines()[0]}"
+    return tool_info
+
+class _SessionHolder:
+    """Owns one long-lived MCP server process and its client session.
+
+    The stdio transport is opened and closed inside a dedicated task because
+    anyio cancel scopes must be exited by the task that entered them.
+    """
+
+    def __init__(self) -> None:
+        self.session: Optional[ClientSession] = None
+        self.valid_tool_names: set = set()
+        self.valid_tools_str: str = ""
+        self.tool_descriptions: List[str] = []
+        self.system_prompt: str = SYSTEM
+        self.step_schema: Optional[Dict[str, Any]] = None
+        self.plan_schema: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._error: Optional[BaseException] = None
+
+    async def _serve(self) -> None:
+        try:
+            async with AsyncExitStack() as stack:
+                stdio = await stack.enter_async_context(
+                    stdio_client(
+                        StdioServerParameters(command=SERVER_COMMAND, args=[SERVER_PATH])
+                    )
+                )
+                r_in, w_out = stdio
+                session = await stack.enter_async_context(ClientSession(r_in, w_out))
+                await session.initialize()
+
+                tools = (await session.list_tools()).tools
+                self.valid_tool_names = {t.name for t in tools}
+                self.valid_tools_str = ", ".join(sorted(self.valid_tool_names))
+                self.tool_descriptions = [format_tool_description(t) for t in tools]
+                self.system_prompt = (
+                    f"{SYSTEM.rstrip()}\n\nTools:\n"
+                    + "\n".join(f"- {desc}" for desc in self.tool_descriptions)
+                )
+                self.step_schema = build_step_schema(self.valid_tool_names)
+                self.plan_schema = build_plan_schema(self.valid_tool_names)
+                self.session = session
+                self._ready.set()
+
+                await self._closing.wait()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def start(self) -> None:
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._error = None
+        self._task = asyncio.create_task(self._serve())
+        await self._ready.wait()
+        if self.session is None:
+            raise RuntimeError(f"Failed to start MCP server: {self._error}") from self._error
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._closing.set()
+        await self._task
+        self._task = None
+
+    async def is_alive(self) -> bool:
+        if self.session is None or self._task is None or self._task.done():
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout=SESSION_PING_TIMEOUT)
+            return True
+        except Exception as e:
+            print(f"[DEBUG] MCP session ping failed: {e}")
+            return False
+
+_session_holder = _SessionHolder()
+_session_lock = asyncio.Lock()
+
+async def get_session() -> _SessionHolder:
+    """Return the shared MCP session, (re)starting the server when it is down."""
+    async with _session_lock:
+        if not await _session_holder.is_alive():
+            await _session_holder.close()
+            await _session_holder.start()
+        return _session_holder
+
+# -----------------------------
+# Tool planning
+# -----------------------------
+PLANNER_INSTRUCTION = (
+    "Before acting, plan ALL tool calls needed for the request above. "
+    "Respond with JSON only:\n"
+    '{"plan":[{"name":"tool_name","args":{...}}],"dependent":false}\n'
+    "- List repeated calls separately (e.g. two dog images = two random_dog calls)\n"
+    '- Set "dependent" to true if any call needs the output of another call '
+    "(e.g. city_to_coords before get_weather)\n"
+    "- Use an empty plan if no tools are needed"
+)
+
+# Keyword -> tool map used to decide locally whether planning can pay off
+INTENT_KEYWORDS = {
+    "get_weather": ("weather", "temperature", "forecast", "wind", "rain", "sunny"),
+    "book_recs": ("book", "books", "read", "novel", "novels", "author"),
+    "random_dog": ("dog", "dogs", "puppy", "puppies", "doggo"),
+    "trivia": ("trivia", "quiz"),
+}
+_KEYWORD_TO_TOOL = {kw: tool for tool, kws in INTENT_KEYWORDS.items() for kw in kws}
+_INTENT_RE = re.compile(r"\b(" + "|".join(map(re.escape, _KEYWORD_TO_TOOL)) + r")\b", re.I)
+_COUNT_RE = re.compile(r"\b(\d+|two|three|four|five|couple|few|several)\b", re.I)
+
+def infer_tool_intents(user_message: str) -> set:
+    """Tools the message clearly asks for, from a single keyword scan."""
+    return {_KEYWORD_TO_TOOL[m.lower()] for m in _INTENT_RE.findall(user_message)}
+
+def needs_planning(user_message: str) -> bool:
+    """A plan only saves LLM turns when several tool calls are expected."""
+    intents = infer_tool_intents(user_message)
+    if len(intents) > 1:
+        return True
+    # Coordinates are numbers too, but never a count of tool calls
+    return bool(intents) and _COUNT_RE.search(_COORD_RE.sub(" ", user_message)) is not None
+
+async def plan_tool_calls(
+    history: List[Dict[str, str]],
+    valid_tool_names: set,
+    schema: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """Ask the LLM for the whole tool plan up front.
+
+    Returns the calls to run concurrently, or an empty list when the plan is
+    empty, invalid or data-dependent (the iterative loop handles those).
+    """
+    decision = await llm_json(
+        history + [{"role": "user", "content": PLANNER_INSTRUCTION}],
+        schema=schema,
+        schema_name="tool_plan",
+    )
+    plan = decision.get("plan")
+    if not isinstance(plan, list) or decision.get("dependent"):
+        return []
+    calls = []
+    for step in plan:
+        if not isinstance(step, dict) or step.get("name") not in valid_tool_names:
+            return []
+        args = step.get("args") or {}
+        calls.append({"name": step["name"], "args": args if isinstance(args, dict) else {}})
+    return calls
+
+# Results of idempotent tools (CACHEABLE_TOOLS) keyed on (name, sorted args),
+# stored as (stored_at, result)
+_tool_cache: "OrderedDict[Tuple[str, bytes], Tuple[float, Any]]" = OrderedDict()
+_TOOL_CACHE_TTLS = {
+    "city_to_coords": GEOCODING_CACHE_TTL,
+    "book_recs": BOOKS_CACHE_TTL,
+}
+
+def _is_error_result(result: Any) -> bool:
+    """True for MCP errors and for tools that report failures as {"error": ...}."""
+    if getattr(result, "isError", False):
+        return True
+    try:
+        data = orjson.loads(normalize_tool_result(result))
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and "error" in data
+
+_TRANSPORT_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, ConnectionError)
+
+# Tools that make several upstream fetches back to back; TOOL_CALL_TIMEOUT
+# covers one fetch including the server's retries.
+_TOOL_FETCH_COUNTS = {"city_weather": 2}
+
+def _tool_call_timeout(name: str) -> float:
+    return TOOL_CALL_TIMEOUT * _TOOL_FETCH_COUNTS.get(name, 1)
+
+async def call_tool_safe(session: ClientSession, name: str, args: Dict[str, Any]):
+    """Call one tool with a timeout, returning the exception instead of raising.
+
+    Keeps one failing or slow tool from cancelling its siblings in a TaskGroup.
+    """
+    cache_key = None
+    if name in CACHEABLE_TOOLS:
+        cache_key = (name, orjson.dumps(args, option=orjson.OPT_SORT_KEYS))
+        cached = _ttl_get(_tool_cache, cache_key, _TOOL_CACHE_TTLS.get(name, TOOL_CACHE_TTL))
+        if cached is not None:
+            return cached
+    timeout = _tool_call_timeout(name)
+    try:
+        result = await asyncio.wait_for(session.call_tool(name, args), timeout=timeout)
+        # Upstream failures must not outlive the outage that caused them
+        if cache_key is not None and not _is_error_result(result):
+            _ttl_put(_tool_cache, cache_key, result, TOOL_CACHE_SIZE)
+        return result
+    except asyncio.TimeoutError:
+        return TimeoutError(f"no response after {timeout:g}s")
+    except _TRANSPORT_ERRORS as e:
+        # The server process went away; get_session() restarts it, retry once
+        print(f"[DEBUG] MCP transport error calling '{name}': {e!r}, restarting server")
+        try:
+            holder = await get_session()
+            return await asyncio.wait_for(holder.session.call_tool(name, args), timeout=timeout)
+        except Exception as retry_error:
+            return retry_error
+    except Exception as e:
+        return e
+
+async def run_parallel_calls(
+    session: ClientSession,
+    calls: List[Dict[str, Any]],
+    tools_used: List[str],
+    failed_tools: List[str],
+    progress: Optional[ProgressCallback] = None,
+) -> str:
+    """Run tool calls concurrently and return their combined results for the LLM.
+
+    Tools that raised or returned an error payload are added to `failed_tools`.
+    """
+    if progress:
+        progress(f"Using {', '.join(c['name'] for c in calls)}…")
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(call_tool_safe(session, c["name"], c.get("args", {})))
+            for c in calls
+        ]
+    results = [t.result() for t in tasks]
+    outputs = []
+    for call, result in zip(calls, results):
+        name = call["name"]
+        if isinstance(result, BaseException):
+            print(f"[DEBUG] Error calling tool '{name}': {result}")
+            failed_tools.append(name)
+            outputs.append(f"Error calling tool '{name}': {str(result)}")
+            continue
+        payload = normalize_tool_result(result)
+        tools_used.append(name)
+        if _is_error_result(result):
+            failed_tools.append(name)
+        print(f"[DEBUG] Tool '{name}' called in parallel with args: {call.get('args', {})}")
+        outputs.append(f"Tool '{name}' returned: {compact_tool_payload(payload)}")
+    return "\n\n".join(outputs)
+
+# -----------------------------
+# Direct intents (no LLM)
+# -----------------------------
+# Short single-intent requests that map to exactly one argument-free tool.
+_SIMPLE_INTENTS = {
+    "random_dog": re.compile(
+        r"\b(dog|puppy|doggo)s?\b.*\b(pic|picture|image|photo)s?\b"
+        r"|\b(pic|picture|image|photo)s?\b.*\b(dog|puppy|doggo)s?\b",
+        re.I,
+    ),
+    "trivia": re.compile(r"\btrivia\b", re.I),
+}
+_MULTI_REQUEST_RE = re.compile(
+    r"\d|\b(and|also|plus|two|three|four|five|several|some|few|weather|book|books)\b", re.I
+)
+
+def match_simple_intent(user_message: str) -> Optional[str]:
+    """Return the one tool a short request asks for, or None if the LLM is needed."""
+    if len(user_message) > DIRECT_INTENT_MAX_CHARS or _MULTI_REQUEST_RE.search(user_message):
+        return None
+    matches = [tool for tool, pattern in _SIMPLE_INTENTS.items() if pattern.search(user_message)]
+    return matches[0] if len(matches) == 1 else None
+
+def format_direct_answer(tool: str, payload: str) -> Optional[str]:
+    try:
+        data = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or "error" in data:
+        return None
+    if tool == "random_dog" and data.get("message"):
+        return f"Here's a random dog to brighten your day! 🐶\n\n![Random dog]({data['message']})"
+    if tool == "trivia" and data.get("question"):
+        options = ", ".join(sorted([data["correct_answer"], *data.get("incorrect_answers", [])]))
+        return (
+            f"🧠 **Trivia** ({data.get('category', 'General')}, {data.get('difficulty', 'unknown')})\n\n"
+            f"{data['question']}\n\n"
+            f"Options: {options}\n\n"
+            f"<details><summary>Show answer</summary>{data['correct_answer']}</details>"
+        )
+    return None
+
+async def try_direct_intent(user_message: str) -> Optional[Dict[str, Any]]:
+    """Answer simple single-tool requests without any LLM round-trip."""
+    # Local checks first: only a match is worth starting or pinging the server
+    tool = match_simple_intent(user_message)
+    if tool is None:
+        return None
+    holder = await get_session()
+    if tool not in holder.valid_tool_names:
+        return None
+    result = await call_tool_safe(holder.session, tool, {})
+    if isinstance(result, BaseException):
+        print(f"[DEBUG] Direct call to '{tool}' failed: {result}")
+        return None
+    answer = format_direct_answer(tool, normalize_tool_result(result))
+    if answer is None:
+        return None
+    print(f"[DEBUG] Direct intent '{tool}' answered without LLM")
+    return {"action": "final", "answer": answer, "tools_used": [tool]}
+
+# -----------------------------
+# History helpers
+# -----------------------------
+def append_turn(history: List[Dict[str, str]], assistant_content: str, user_content: str) -> None:
+    """Record one assistant step and the user-side reply to it."""
+    history.extend((
+        {"role": "assistant", "content": assistant_content},
+        {"role": "user", "content": user_content},
+    ))
+
+def trim_history(history: List[Dict[str, str]], start: int) -> None:
+    """Keep the per-request part of history within MAX_HISTORY_CHARS.
+
+    Older tool results (from index `start`, excluding the latest turn) are
+    cut to a short head, oldest first, until the budget fits. The system
+    prefix and the user's request are never touched.
+    """
+    total = sum(len(m["content"]) for m in history[start:])
+    for msg in history[start:-2]:
+        if total <= MAX_HISTORY_CHARS:
+            return
+        content = msg["content"]
+        if msg["role"] != "user" or len(content) <= TRIMMED_RESULT_CHARS:
+            continue
+        msg["content"] = content[:TRIMMED_RESULT_CHARS] + "...(trimmed)"
+        total -= len(content) - len(msg["content"])
+
+def fallback_answer(history: List[Dict[str, str]]) -> str:
+    """Best-effort answer from the tool outputs in history when the LLM gives none."""
+    outputs = [
+        part
+        for msg in history
+        if msg["role"] == "user"
+        for part in msg["content"].split("\n\n")
+        if part.startswith("Tool '")
+    ]
+    if not outputs:
+        return "Sorry, I couldn't complete that request. Please try rephrasing it."
+    lines = [
+        f"- {part[:TRIMMED_RESULT_CHARS]}{'…' if len(part) > TRIMMED_RESULT_CHARS else ''}"
+        for part in outputs
+    ]
+    return "I couldn't put together a full answer, but here is what I found:\n\n" + "\n".join(lines)
 
 # -----------------------------
 # MAIN AGENT LOOP (UI-safe)
 # -----------------------------
-async def run_agent_once(user_message: str) -> Dict[str, Any]:
-    server_path = SERVER_PATH
+async def run_agent_once(
+    user_message: str, progress: Optional[ProgressCallback] = None
+) -> Dict[str, Any]:
+    # The favorite genre is only learned from and used for book requests:
+    # "trivia about history" must not overwrite it, and elsewhere the hint is
+    # just extra tokens re-sent on every step. Recorded before the cache
+    # lookup so cache hits still update the preference.
+    favorite_genre = None
+    if "book_recs" in infer_tool_intents(user_message):
+        genre = extract_genre(user_message)
+        if genre:
+            set_pref("favorite_genre", genre)
+        favorite_genre = get_pref("favorite_genre")
+
+    coords = parse_coords(user_message)
+    cache_key = None if coords else _cache_key(user_message)
+    if cache_key and favorite_genre:
+        # Answers built with the genre hint are only valid for that genre
+        cache_key = f"{cache_key} | genre:{favorite_genre}"
+    if cache_key:
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            print(f"[DEBUG] Response cache hit for: {cache_key[:60]}")
+            return cached
+
+    if DIRECT_INTENTS_ENABLED:
+        direct = await try_direct_intent(user_message)
+        if direct is not None:
+            return direct
 
+    result = await _run_agent_loop(user_message, coords, favorite_genre, progress)
+    if cache_key:
+        store_cached_response(cache_key, result)
+    return result
+
+async def _run_agent_loop(
+    user_message: str,
+    coords: Optional[Tuple[float, float]] = None,
+    favorite_genre: Optional[str] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> Dict[str, Any]:
     original_user_query = user_message
-    user_message = compress_large_input(user_message)
+
+    # Compression (an LLM call, only for long inputs) and MCP session setup
+    # are independent, so overlap them.
+    async with asyncio.TaskGroup() as tg:
+        session_task = tg.create_task(get_session())
+        if len(user_message) > MAX_PROMPT_CHARS:
+            user_message = await compress_large_input(user_message)
+    holder = session_task.result()
 
     tools_used: List[str] = []
+    # Tools that failed or returned an error payload; answers built on them
+    # are marked degraded so they are not cached.
+    failed_tools: List[str] = []
+
+    session = holder.session
+    valid_tool_names = holder.valid_tool_names
 
+    # The system message is identical across steps and requests, so the
+    # provider can reuse its cached prefix; only the suffix changes.
     history: List[Dict[str, str]] = [
-        {"role": "system", "content": SYSTEM},
+        {"role": "system", "content": holder.system_prompt},
         {"role": "user", "content": user_message},
     ]
-
-    async with AsyncExitStack() as stack:
-        stdio = await stack.enter_async_context(
-            stdio_client(
-                StdioServerParameters(command=SERVER_COMMAND, args=[server_path])
-            )
-        )
-        r_in, w_out = stdio
-        session = await stack.enter_async_context(ClientSession(r_in, w_out))
-        await session.initialize()
-
-        tools = (await session.list_tools()).tools
-        valid_tool_names = {t.name for t in tools}
-
-        # Create tool descriptions for the LLM
-        tool_descriptions = []
-        for tool in tools:
-            tool_info = f"{tool.name}"
-            if tool.description:
-                tool_info += f": {tool.description}"
-            if hasattr(tool, 'inputSchema') and tool.inputSchema:
-                schema = tool.inputSchema
-                if 'properties' in schema:
-                    args = []
-                    for prop_name, prop_info in schema['properties'].items():
-                        arg_desc = prop_name
-                        if isinstance(prop_info, dict) and 'description' in prop_info:
-                            arg_desc += f" ({prop_info['description']})"
-                        args.append(arg_desc)
-                    if args:
-                        tool_info += f" - args: {', '.join(args)}"
-            tool_descriptions.append(tool_info)
-        
-        # Add tool info to history
-        history.insert(1, {
+    if favorite_genre:
+        history.append({
             "role": "user",
-            "content": f"Available tools:\n" + "\n".join(f"- {desc}" for desc in tool_descriptions)
+            "content": f"User's favorite book genre: {favorite_genre} (use it for book_recs when no topic is given)."
+        })
+    if coords:
+        history.append({
+            "role": "user",
+            "content": f"Hint: Coordinates detected (latitude={coords[0]}, longitude={coords[1]}). Use get_weather directly."
         })
 
-        for _ in range(MAX_STEPS):
-            decision = llm_json(history)
-            action = decision.get("action")
-
-            # ---------- FINAL ----------
-            if action == "final":
-                return {
-                    "action": "final",
-                    "answer": decision.get("answer", ""),
-                    "tools_used": tools_used,
-                }
-
-            # ---------- INVALID ACTION ----------
-            if not action:
-                history.append({
-                    "role": "assistant",
-                    "content": json.dumps(decision)
-                })
-                history.append({
-                    "role": "user",
-                    "content": "You must either call a valid tool or finalize."
-                })
-                continue
+    # Independent tool calls are planned in one LLM turn and run together;
+    # anything left over (or a dependent plan) goes through the loop below.
+    if PLANNER_MODE and needs_planning(original_user_query):
+        calls = await plan_tool_calls(history, valid_tool_names, holder.plan_schema)
+        if calls:
+            outputs = await run_parallel_calls(session, calls, tools_used, failed_tools, progress)
+            append_turn(
+                history,
+                _dumps({"action": "parallel", "calls": calls}),
+                outputs + "\n\nNow provide the final answer, or call another tool if something is missing.",
+            )
 
-            if action not in valid_tool_names:
-                history.append({
-                    "role": "assistant",
-                    "content": json.dumps(decision)
-                })
-                history.append({
-                    "role": "user",
-                    "content": f"'{action}' is not a valid tool. Available tools: {', '.join(valid_tool_names)}"
-                })
-                continue
+    recent_steps: Deque[int] = deque(maxlen=3)
+    prefix_len = len(history)
+
+    for _ in range(MAX_STEPS):
+        trim_history(history, prefix_len)
+        decision = await llm_json(history, holder.step_schema)
+        action = decision.get("action")
+
+        # ---------- FINAL ----------
+        if action == "final":
+            return {
+                "action": "final",
+                "answer": decision.get("answer", ""),
+                "tools_used": tools_used,
+                "degraded": bool(decision.get("degraded") or failed_tools),
+            }
+
+        # ---------- STUCK LOOP ----------
+        # The same decision again means the model is not making progress;
+        # stop spending LLM calls and force the final answer below.
+        step_hash = hash(orjson.dumps(decision, option=orjson.OPT_SORT_KEYS))
+        if step_hash in recent_steps:
+            print(f"[DEBUG] Repeated decision {action!r}, forcing final answer")
+            break
+        recent_steps.append(step_hash)
 
-            if action in tools_used:
-                history.append({
-                    "role": "assistant",
-                    "content": json.dumps(decision)
-                })
-                history.append({
-                    "role": "user",
-                    "content": f"Tool '{action}' already used. Choose another tool or finalize."
-                })
+        # ---------- PARALLEL TOOL CALLS ----------
+        if action == "parallel":
+            calls = [
+                c for c in decision.get("calls", [])
+                if isinstance(c, dict)
+                and c.get("name") in valid_tool_names
+                and c.get("name") not in tools_used
+            ]
+            if not calls:
+                append_turn(
+                    history,
+                    _dumps(decision),
+                    f"No valid unused tools in 'parallel' calls. Available tools: {holder.valid_tools_str}",
+                )
                 continue
 
-            # ---------- TOOL CALL ----------
-            args = decision.get("args", {})
-            try:
-                result = await session.call_tool(action, args)
-                payload = normalize_tool_result(result)
-                tools_used.append(action)
-                
-                # Debug: print what we got
-                print(f"[DEBUG] Tool '{action}' called with args: {args}")
-                print(f"[DEBUG] Tool result payload: {payload[:200]}...")
-                
-                # Add assistant acknowledgment, then user with tool result
-                history.append({
-                    "role": "assistant",
-                    "content": json.dumps({"action": action, "args": args})
-                })
-                history.append({
-                    "role": "user",
-                    "content": f"Tool '{action}' returned: {payload}\n\nNow either call another tool or provide the final answer."
-                })
-            except Exception as e:
-                error_msg = f"Error calling tool '{action}': {str(e)}"
-                print(f"[DEBUG] {error_msg}")
-                history.append({
-                    "role": "assistant",
-                    "content": json.dumps({"action": action, "args": args})
-                })
-                history.append({
-                    "role": "user",
-                    "content": error_msg + "\n\nChoose a different tool or provide final answer."
-                })
-
-        # If MAX_STEPS hit, force final safely
-        history.append({
-            "role": "user",
-            "content": (
-                "Now generate the FINAL answer.\n\n"
-                f"User's original request:\n{original_user_query}\n\n"
-                "Use ALL relevant tool outputs above."
+            outputs = await run_parallel_calls(session, calls, tools_used, failed_tools, progress)
+            append_turn(history, _dumps({"action": "parallel", "calls": calls}), outputs)
+            continue
+
+        # ---------- INVALID ACTION ----------
+        if not action:
+            append_turn(history, _dumps(decision), "You must either call a valid tool or finalize.")
+            continue
+
+        if action not in valid_tool_names:
+            append_turn(
+                history,
+                _dumps(decision),
+                f"'{action}' is not a valid tool. Available tools: {holder.valid_tools_str}",
             )
-        })
-        decision = llm_json(history)
-        return {
-            "action": "final",
-            "answer": decision.get("answer", ""),
-            "tools_used": tools_used,
-        }
-
-if __name__ == "__main__":
-    pass
\ No newline at end of file
+            continue
+
+        if action in tools_used:
+            append_turn(
+                history,
+                _dumps(decision),
+                f"Tool '{action}' already used. Choose another tool or finalize.",
+            )
+            continue
+
+        # ---------- TOOL CALL ----------
+        args = decision.get("args", {})
+        if progress:
+            progress(f"Using {action}…")
+        try:
+            result = await call_tool_safe(session, action, args)
+            if isinstance(result, BaseException):
+                raise result
+            payload = normalize_tool_result(result)
+            tools_used.append(action)
+            if _is_error_result(result):
+                failed_tools.append(action)
+            
+            # Debug: print what we got
+            print(f"[DEBUG] Tool '{action}' called with args: {args}")
+            print(f"[DEBUG] Tool result payload: {payload[:200]}...")
+            
+            # Add assistant acknowledgment, then user with tool result
+            append_turn(
+                history,
+                _dumps({"action": action, "args": args}),
+                f"Tool '{action}' returned: {compact_tool_payload(payload)}",
+            )
+        except Exception as e:
+            error_msg = f"Error calling tool '{action}': {str(e)}"
+            print(f"[DEBUG] {error_msg}")
+            failed_tools.append(action)
+            append_turn(history, _dumps({"action": action, "args": args}), error_msg)
+
+    # If MAX_STEPS hit (or the loop got stuck), force final safely
+    history.append({
+        "role": "user",
+        "content": (
+            "Now generate the FINAL answer.\n\n"
+            f"User's original request:\n{original_user_query}\n\n"
+            "Use ALL relevant tool outputs above."
+        )
+    })
+    decision = await llm_json(history, FINAL_STEP_SCHEMA, schema_name="final_answer")
+    answer = decision.get("answer", "").strip() if decision.get("action") == "final" else ""
+    return {
+        "action": "final",
+        "answer": answer or fallback_answer(history),
+        "tools_used": tools_used,
+        "degraded": bool(not answer or decision.get("degraded") or failed_tools),
+    }
+
+async def run_agent_stream(user_message: str) -> AsyncIterator[Dict[str, Any]]:
+    """Run the agent, yielding status updates before the final result.
+
+    Yields {"action": "status", "message": ...} whenever tools are about to
+    run, then the same dict run_agent_once returns.
+    """
+    updates: asyncio.Queue = asyncio.Queue()
+    agent_task = asyncio.create_task(run_agent_once(user_message, progress=updates.put_nowait))
+    try:
+        while True:
+            next_update = asyncio.create_task(updates.get())
+            done, _ = await asyncio.wait(
+                {next_update, agent_task}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_update in done:
+                yield {"action": "status", "message": next_update.result()}
+                continue
+            next_update.cancel()
+            break
+        yield agent_task.result()
+    finally:
+        if not agent_task.done():
+            agent_task.cancel()
@@ -1,8 +1,9 @@
 # app.py
 import gradio as gr
+from collections import Counter
 from datetime import datetime
 
-from agent import run_agent_once
+from agent import run_agent_stream
 from config import (
     GRADIO_THEME,
     GRADIO_CHATBOT_HEIGHT,
@@ -32,7 +33,15 @@ def get_greeting():
 
 
 async def agent_reply(message, history):
-    result = await run_agent_once(user_message=message)
+    # Show tool progress in the reply bubble while the agent works
+    result = {}
+    status_lines = []
+    async for event in run_agent_stream(message):
+        if event.get("action") == "status":
+            status_lines.append(f"_🔧 {event['message']}_")
+            yield "\n\n".join(status_lines)
+        else:
+            result = event
 
     answer = result.get("answer", "").strip()
     tools = result.get("tools_used", [])
@@ -46,14 +55,18 @@ async def agent_reply(message, history):
 
     # Format output with tools used
     if tools:
-        tools_text = ", ".join(tools)
+        tool_counts = Counter(tools)
+        tools_text = ", ".join(
+            f"{name} ({count}x)" if count > 1 else name
+            for name, count in tool_counts.items()
+        )
         answer = (
             f"{answer}\n\n"
             f"---\n"
             f"🛠️ **Tools used:** {tools_text}"
         )
     
-    return answer
+    yield answer
 
 
 CUSTOM_CSS = """
@@ -140,6 +153,13 @@ with gr.Blocks() as demo:
 
 
 if __name__ == "__main__":
+    # Faster event loop for the agent's network and stdio I/O where available
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Get theme dynamically from config
     theme_name = GRADIO_THEME
     theme = getattr(gr.themes, theme_name, gr.themes.Soft)()
@@ -7,75 +7,166 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Snapshot the environment once (after .env is applied) and resolve every
+# setting below against the plain dict.
+_ENV = dict(os.environ)
+
+# Typed readers: defaults are passed as typed values, so an unset variable
+# returns the default as-is without a str -> int/float round-trip.
+def _get_int(name: str, default: int) -> int:
+    value = _ENV.get(name)
+    return int(value) if value is not None else default
+
+def _get_float(name: str, default: float) -> float:
+    value = _ENV.get(name)
+    return float(value) if value is not None else default
+
+def _get_bool(name: str, default: bool) -> bool:
+    value = _ENV.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def _get_list(name: str, default: list) -> list:
+    """Comma-separated list with surrounding whitespace and empty items dropped."""
+    value = _ENV.get(name)
+    if value is None:
+        return list(default)
+    return [item.strip() for item in value.split(",") if item.strip()]
+
 # API Configuration
-CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
+CEREBRAS_API_KEY = _ENV.get("CEREBRAS_API_KEY")
 
 # Model Configuration
-MODEL = os.getenv("MODEL", "qwen-3-32b")
-TEMPERATURE = float(os.getenv("TEMPERATURE", "0.2"))
-COMPRESSION_TEMPERATURE = float(os.getenv("COMPRESSION_TEMPERATURE", "0.1"))
+MODEL = _ENV.get("MODEL", "qwen-3-32b")
+TEMPERATURE = _get_float("TEMPERATURE", 0.2)
+COMPRESSION_TEMPERATURE = _get_float("COMPRESSION_TEMPERATURE", 0.1)
+
+# LLM HTTP Client Configuration
+LLM_MAX_CONNECTIONS = _get_int("LLM_MAX_CONNECTIONS", 40)
+LLM_MAX_KEEPALIVE_CONNECTIONS = _get_int("LLM_MAX_KEEPALIVE_CONNECTIONS", 20)
+LLM_KEEPALIVE_EXPIRY = _get_float("LLM_KEEPALIVE_EXPIRY", 300.0)
+LLM_CONNECT_TIMEOUT = _get_float("LLM_CONNECT_TIMEOUT", 2.0)
+LLM_READ_TIMEOUT = _get_float("LLM_READ_TIMEOUT", 30.0)
 
 # Agent Configuration
-MAX_STEPS = int(os.getenv("MAX_STEPS", "8"))
-MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "8000"))
-MAX_COMPRESSION_TOKENS = int(os.getenv("MAX_COMPRESSION_TOKENS", "300"))
+MAX_STEPS = _get_int("MAX_STEPS", 8)
+MAX_PROMPT_CHARS = _get_int("MAX_PROMPT_CHARS", 8000)
+MAX_COMPRESSION_TOKENS = _get_int("MAX_COMPRESSION_TOKENS", 300)
+COMPRESSION_TIMEOUT = _get_float("COMPRESSION_TIMEOUT", 2.0)
+MAX_TOOL_PAYLOAD_CHARS = _get_int("MAX_TOOL_PAYLOAD_CHARS", 6000)
+MAX_TOOL_FIELD_CHARS = _get_int("MAX_TOOL_FIELD_CHARS", 500)
+MAX_HISTORY_CHARS = _get_int("MAX_HISTORY_CHARS", 16000)
+TRIMMED_RESULT_CHARS = _get_int("TRIMMED_RESULT_CHARS", 400)
+PLANNER_MODE = _get_bool("PLANNER_MODE", True)
+DIRECT_INTENTS_ENABLED = _get_bool("DIRECT_INTENTS_ENABLED", True)
+DIRECT_INTENT_MAX_CHARS = _get_int("DIRECT_INTENT_MAX_CHARS", 80)
 
 # File Paths
-PREF_FILE = os.getenv("PREF_FILE", "preferences.json")
-SERVER_PATH = os.getenv("SERVER_PATH", "server.py")
-SYSTEM_PROMPT_FILE = os.getenv("SYSTEM_PROMPT_FILE", "system_prompt.txt")
+PREF_FILE = _ENV.get("PREF_FILE", "preferences.json")
+SERVER_PATH = _ENV.get("SERVER_PATH", "server.py")
+SYSTEM_PROMPT_FILE = _ENV.get("SYSTEM_PROMPT_FILE", "system_prompt.txt")
 
 # Server Configuration
-SERVER_COMMAND = os.getenv("SERVER_COMMAND", "python")
+SERVER_COMMAND = _ENV.get("SERVER_COMMAND", "python")
+SESSION_PING_TIMEOUT = _get_float("SESSION_PING_TIMEOUT", 0.5)
+
+# Response Cache Configuration
+RESPONSE_CACHE_SIZE = _get_int("RESPONSE_CACHE_SIZE", 128)
+RESPONSE_CACHE_TTL = _get_int("RESPONSE_CACHE_TTL", 600)
+LLM_CACHE_SIZE = _get_int("LLM_CACHE_SIZE", 256)
+LLM_CACHE_TTL = _get_int("LLM_CACHE_TTL", 600)
+TOOL_CACHE_SIZE = _get_int("TOOL_CACHE_SIZE", 256)
+TOOL_CACHE_TTL = _get_int("TOOL_CACHE_TTL", 600)
+CACHEABLE_TOOLS = _get_list("CACHEABLE_TOOLS", ["city_to_coords", "book_recs"])
 
 # Tool Configuration - Retry Settings
-TOOL_RETRY_COUNT = int(os.getenv("TOOL_RETRY_COUNT", "3"))
-TOOL_TIMEOUT = int(os.getenv("TOOL_TIMEOUT", "15"))
+TOOL_RETRY_COUNT = _get_int("TOOL_RETRY_COUNT", 3)
+TOOL_TIMEOUT = _get_int("TOOL_TIMEOUT", 15)
+TOOL_BACKOFF_BASE = _get_float("TOOL_BACKOFF_BASE", 0.5)
+TOOL_BACKOFF_MAX = _get_float("TOOL_BACKOFF_MAX", 8.0)
+TOOL_BACKOFF_JITTER = _get_float("TOOL_BACKOFF_JITTER", 0.25)
+
+# Client-side limit for one MCP tool call that makes a single upstream fetch.
+# Derived from the server's worst case (every attempt times out, with the
+# longest backoff sleeps in between) plus a second of margin, so the agent
+# never gives up while the server is still retrying.
+TOOL_CALL_TIMEOUT = _get_float(
+    "TOOL_CALL_TIMEOUT",
+    TOOL_TIMEOUT * TOOL_RETRY_COUNT
+    + sum(
+        min(TOOL_BACKOFF_MAX, TOOL_BACKOFF_BASE * 2 ** i) + TOOL_BACKOFF_JITTER
+        for i in range(TOOL_RETRY_COUNT - 1)
+    )
+    + 1.0,
+)
+
+# Tool Configuration - HTTP Connection Pool
+HTTP_MAX_CONNECTIONS = _get_int("HTTP_MAX_CONNECTIONS", 32)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = _get_int("HTTP_MAX_KEEPALIVE_CONNECTIONS", 16)
+HTTP_USER_AGENT = _ENV.get("HTTP_USER_AGENT", "WeekendWizard/1.0")
+
+# Tool Configuration - Result Cache (seconds)
+GEOCODING_CACHE_TTL = _get_int("GEOCODING_CACHE_TTL", 86400)
+WEATHER_CACHE_TTL = _get_int("WEATHER_CACHE_TTL", 600)
+TOOL_RESULT_CACHE_SIZE = _get_int("TOOL_RESULT_CACHE_SIZE", 1024)
+BOOKS_CACHE_TTL = _get_int("BOOKS_CACHE_TTL", 3600)
+# On-disk response cache shared across restarts; set to an empty string to disable
+HTTP_CACHE_FILE = _ENV.get("HTTP_CACHE_FILE", "http_cache.sqlite")
 
 # Tool Configuration - API Endpoints
-GEOCODING_API_URL = os.getenv("GEOCODING_API_URL", "https://geocoding-api.open-meteo.com/v1/search")
-WEATHER_API_URL = os.getenv("WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast")
-BOOKS_API_URL = os.getenv("BOOKS_API_URL", "https://www.googleapis.com/books/v1/volumes")
-DOG_API_URL = os.getenv("DOG_API_URL", "https://dog.ceo/api/breeds/image/random")
-TRIVIA_API_URL = os.getenv("TRIVIA_API_URL", "https://opentdb.com/api.php")
+GEOCODING_API_URL = _ENV.get("GEOCODING_API_URL", "https://geocoding-api.open-meteo.com/v1/search")
+WEATHER_API_URL = _ENV.get("WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast")
+BOOKS_API_URL = _ENV.get("BOOKS_API_URL", "https://www.googleapis.com/books/v1/volumes")
+DOG_API_URL = _ENV.get("DOG_API_URL", "https://dog.ceo/api/breeds/image/random")
+TRIVIA_API_URL = _ENV.get("TRIVIA_API_URL", "https://opentdb.com/api.php")
 
 # Tool Configuration - API Parameters
-GEOCODING_COUNT = int(os.getenv("GEOCODING_COUNT", "1"))
-BOOK_RECS_LIMIT = int(os.getenv("BOOK_RECS_LIMIT", "5"))
-TRIVIA_AMOUNT = int(os.getenv("TRIVIA_AMOUNT", "1"))
-TRIVIA_TYPE = os.getenv("TRIVIA_TYPE", "multiple")
+GEOCODING_COUNT = _get_int("GEOCODING_COUNT", 1)
+BOOK_RECS_LIMIT = _get_int("BOOK_RECS_LIMIT", 5)
+TRIVIA_AMOUNT = _get_int("TRIVIA_AMOUNT", 1)
+TRIVIA_TYPE = _ENV.get("TRIVIA_TYPE", "multiple")
 
 # Weather API Parameters
-WEATHER_CURRENT_PARAMS = os.getenv("WEATHER_CURRENT_PARAMS", "temperature_2m,weather_code,wind_speed_10m")
-WEATHER_TIMEZONE = os.getenv("WEATHER_TIMEZONE", "auto")
+WEATHER_CURRENT_PARAMS = _ENV.get("WEATHER_CURRENT_PARAMS", "temperature_2m,weather_code,wind_speed_10m")
+WEATHER_TIMEZONE = _ENV.get("WEATHER_TIMEZONE", "auto")
 
 # MCP Server Configuration
-MCP_SERVER_NAME = os.getenv("MCP_SERVER_NAME", "WeekendWizardTools")
+MCP_SERVER_NAME = _ENV.get("MCP_SERVER_NAME", "WeekendWizardTools")
+
+# User Preferences - Persistence
+PREFS_FLUSH_INTERVAL = _get_float("PREFS_FLUSH_INTERVAL", 1.0)
 
 # User Preferences - Genre Detection
-DETECTED_GENRES = os.getenv("DETECTED_GENRES", "sci-fi,science fiction,fantasy,romance,mystery,thriller,history,philosophy").split(",")
+DETECTED_GENRES = frozenset(
+    g.lower()
+    for g in _get_list(
+        "DETECTED_GENRES",
+        ["sci-fi", "science fiction", "fantasy", "romance", "mystery", "thriller", "history", "philosophy"],
+    )
+)
 
 # Gradio UI Configuration
-GRADIO_THEME = os.getenv("GRADIO_THEME", "Soft")
-GRADIO_CHATBOT_HEIGHT = int(os.getenv("GRADIO_CHATBOT_HEIGHT", "420"))
-GRADIO_TEXTBOX_SCALE = int(os.getenv("GRADIO_TEXTBOX_SCALE", "7"))
+GRADIO_THEME = _ENV.get("GRADIO_THEME", "Soft")
+GRADIO_CHATBOT_HEIGHT = _get_int("GRADIO_CHATBOT_HEIGHT", 420)
+GRADIO_TEXTBOX_SCALE = _get_int("GRADIO_TEXTBOX_SCALE", 7)
 
 # UI Text Configuration
-UI_TITLE = os.getenv("UI_TITLE", "weekend - wizard")
-UI_PLACEHOLDER = os.getenv("UI_PLACEHOLDER", "Tell me how you're feeling or what you need...")
-UI_SUBMIT_BUTTON = os.getenv("UI_SUBMIT_BUTTON", "✨ Ask")
+UI_TITLE = _ENV.get("UI_TITLE", "weekend - wizard")
+UI_PLACEHOLDER = _ENV.get("UI_PLACEHOLDER", "Tell me how you're feeling or what you need...")
+UI_SUBMIT_BUTTON = _ENV.get("UI_SUBMIT_BUTTON", "✨ Ask")
 
 # Greeting Configuration
-GREETING_MORNING = os.getenv("GREETING_MORNING", "Good Morning ☀️")
-GREETING_AFTERNOON = os.getenv("GREETING_AFTERNOON", "Good Afternoon 🌤️")
-GREETING_EVENING = os.getenv("GREETING_EVENING", "Good Evening ✨")
-MORNING_HOUR_CUTOFF = int(os.getenv("MORNING_HOUR_CUTOFF", "12"))
-AFTERNOON_HOUR_CUTOFF = int(os.getenv("AFTERNOON_HOUR_CUTOFF", "17"))
+GREETING_MORNING = _ENV.get("GREETING_MORNING", "Good Morning ☀️")
+GREETING_AFTERNOON = _ENV.get("GREETING_AFTERNOON", "Good Afternoon 🌤️")
+GREETING_EVENING = _ENV.get("GREETING_EVENING", "Good Evening ✨")
+MORNING_HOUR_CUTOFF = _get_int("MORNING_HOUR_CUTOFF", 12)
+AFTERNOON_HOUR_CUTOFF = _get_int("AFTERNOON_HOUR_CUTOFF", 17)
 
 # Logging Configuration
-LOG_SEPARATOR_WIDTH = int(os.getenv("LOG_SEPARATOR_WIDTH", "60"))
-LOG_MESSAGE_PREVIEW_LENGTH = int(os.getenv("LOG_MESSAGE_PREVIEW_LENGTH", "80"))
-LOG_RESPONSE_PREVIEW_LENGTH = int(os.getenv("LOG_RESPONSE_PREVIEW_LENGTH", "100"))
+LOG_SEPARATOR_WIDTH = _get_int("LOG_SEPARATOR_WIDTH", 60)
+LOG_MESSAGE_PREVIEW_LENGTH = _get_int("LOG_MESSAGE_PREVIEW_LENGTH", 80)
+LOG_RESPONSE_PREVIEW_LENGTH = _get_int("LOG_RESPONSE_PREVIEW_LENGTH", 100)
 
 # Validation
 def validate_config():
@@ -90,38 +181,18 @@ def load_system_prompt():
         with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
             return f.read()
     # Default prompt if file doesn't exist
-    return """You are an autonomous AI agent with access to external tools via MCP.
-You MUST always respond in valid JSON format.
-
-========================
-CORE BEHAVIOR
-========================
-- Be friendly, concise, and accurate
-- If real-world, dynamic, or factual data is required, call the appropriate tool
-- NEVER hallucinate or make up tool results
-- Use actual tool output values in your final answer
-
-========================
-TOOL RULES
-========================
-- Call ONE tool at a time
+    return """You are an autonomous AI agent with MCP tools. Reply with ONE valid JSON object only.
+
+Rules:
+- Be friendly, concise and accurate
+- Call a tool for real-time or factual data (weather, books, jokes, trivia, etc.)
+- Use actual tool output; NEVER invent results, tool names or arguments
 - NEVER repeat a tool that has already been called
-- NEVER invent tool names or arguments
-- Use tools when you need real-time data (weather, books, jokes, trivia, etc.)
-- When a user asks for book recommendations, use the book_recs tool with the topic
-- When coordinates (latitude, longitude) are provided in the format (lat, long) or "lat, long", extract them and use get_weather tool directly
-- For city names, use city_to_coords first, then get_weather with the returned coordinates
-
-Tool call format:
-{"action":"tool_name","args":{...}}
-
-========================
-FINAL OUTPUT
-========================
-When you have all the information needed, respond with:
-
-{
-  "action": "final",
-  "answer": "Your response using the tool data"
-}
+- After each tool result (or error), call another tool or give the final answer
+- Coordinates given: call get_weather directly. City name: call city_weather (geocodes and fetches weather in one call)
+
+Formats:
+tool:     {"action":"tool_name","args":{...}}
+parallel: {"action":"parallel","calls":[{"name":"tool_name","args":{...}}]} (only independent tools)
+final:    {"action":"final","answer":"your response using the tool data"}
 """
@@ -1,14 +1,31 @@
 # server.py
 from mcp.server.fastmcp import FastMCP
-from typing import Dict, Any, List
-import requests
-import html
+from typing import Dict, Any, List, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import random
+import re
+import sqlite3
 import time
+from urllib.parse import urlencode
+import httpx
+import orjson
 
 from config import (
     MCP_SERVER_NAME,
     TOOL_RETRY_COUNT,
     TOOL_TIMEOUT,
+    TOOL_BACKOFF_BASE,
+    TOOL_BACKOFF_MAX,
+    TOOL_BACKOFF_JITTER,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_USER_AGENT,
+    GEOCODING_CACHE_TTL,
+    WEATHER_CACHE_TTL,
+    TOOL_RESULT_CACHE_SIZE,
+    BOOKS_CACHE_TTL,
+    HTTP_CACHE_FILE,
     GEOCODING_API_URL,
     GEOCODING_COUNT,
     WEATHER_API_URL,
@@ -24,80 +41,244 @@ from config import (
 
 mcp = FastMCP(MCP_SERVER_NAME)
 
+# Shared async HTTP client: tool calls reuse pooled keep-alive connections and
+# no longer block the server's event loop while waiting on upstream APIs.
+# Retries are handled by get_with_retry, so the transport itself never retries.
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=TOOL_TIMEOUT,
+    # JSON bodies (especially Google Books descriptions) compress well; httpx
+    # decodes br via the brotli extra and gzip via zlib.
+    headers={"Accept-Encoding": "br, gzip", "User-Agent": HTTP_USER_AGENT},
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+)
+
+# -------------------------
+# Helper: on-disk response cache
+# -------------------------
+# Successful responses are kept in SQLite keyed on URL + params, so restarting
+# the server does not re-hit the same endpoints. Endpoints missing from this
+# table (dog images, trivia) should return something new on every call and
+# are never persisted.
+_DISK_CACHE_TTLS = {
+    GEOCODING_API_URL: GEOCODING_CACHE_TTL,
+    WEATHER_API_URL: WEATHER_CACHE_TTL,
+    BOOKS_API_URL: BOOKS_CACHE_TTL,
+}
+
+def _purge_expired(db: sqlite3.Connection) -> None:
+    """Drop stale rows on startup so per-coordinate weather keys cannot pile up."""
+    now = time.time()
+    for url, ttl in _DISK_CACHE_TTLS.items():
+        prefix = f"{url}?"
+        db.execute(
+            "DELETE FROM responses WHERE substr(key, 1, ?) = ? AND stored_at < ?",
+            (len(prefix), prefix, now - ttl),
+        )
+    # Rows from endpoints no longer configured: keep at most the longest TTL
+    db.execute(
+        "DELETE FROM responses WHERE stored_at < ?",
+        (now - max(_DISK_CACHE_TTLS.values()),),
+    )
+
+def _open_disk_cache() -> Optional[sqlite3.Connection]:
+    if not HTTP_CACHE_FILE:
+        return None
+    try:
+        db = sqlite3.connect(HTTP_CACHE_FILE, isolation_level=None)
+        # WAL keeps the per-response write cheap enough to do inline
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, stored_at REAL NOT NULL, body BLOB NOT NULL)"
+        )
+        _purge_expired(db)
+        return db
+    except sqlite3.Error:
+        return None
+
+_disk_cache = _open_disk_cache()
+
+def _disk_get(key: str, ttl: int) -> Optional[bytes]:
+    try:
+        row = _disk_cache.execute(
+            "SELECT stored_at, body FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    # Wall-clock time, since entries outlive the process that wrote them
+    if time.time() - row[0] > ttl:
+        try:
+            _disk_cache.execute("DELETE FROM responses WHERE key = ?", (key,))
+        except sqlite3.Error:
+            pass
+        return None
+    return row[1]
+
+def _disk_put(key: str, body: bytes) -> None:
+    try:
+        _disk_cache.execute(
+            "INSERT OR REPLACE INTO responses (key, stored_at, body) VALUES (?, ?, ?)",
+            (key, time.time(), body),
+        )
+    except sqlite3.Error:
+        pass
+
 # -------------------------
 # Helper: retry + backoff
 # -------------------------
-def get_with_retry(url: str, params=None, retries: int = None, timeout: int = None):
+# Exponential delays are computed once; each retry adds fresh jitter so tools
+# failing at the same moment do not hit the upstream API again in lockstep.
+_BACKOFFS = tuple(
+    min(TOOL_BACKOFF_MAX, TOOL_BACKOFF_BASE * 2 ** i) for i in range(max(TOOL_RETRY_COUNT, 1))
+)
+
+async def get_with_retry(url: str, params=None, retries: int = None, timeout: int = None):
     if retries is None:
         retries = TOOL_RETRY_COUNT
     if timeout is None:
         timeout = TOOL_TIMEOUT
+
+    ttl = _DISK_CACHE_TTLS.get(url) if _disk_cache is not None else None
+    if ttl:
+        key = f"{url}?{urlencode(sorted((params or {}).items()))}"
+        body = _disk_get(key, ttl)
+        if body is not None:
+            return httpx.Response(200, content=body, request=httpx.Request("GET", url, params=params))
+
     for i in range(retries):
         try:
-            r = requests.get(url, params=params, timeout=timeout)
+            r = await _http.get(url, params=params, timeout=timeout)
             r.raise_for_status()
+            if ttl:
+                _disk_put(key, r.content)
             return r
         except Exception:
             if i == retries - 1:
                 raise
-            time.sleep(2 ** i)
+            await asyncio.sleep(
+                _BACKOFFS[min(i, len(_BACKOFFS) - 1)] + random.uniform(0, TOOL_BACKOFF_JITTER)
+            )
+
+def _json(r: httpx.Response) -> Any:
+    """Decode a response body with orjson instead of the stdlib parser."""
+    return orjson.loads(r.content)
+
+# -------------------------
+# Helper: TTL result cache
+# -------------------------
+# Maps a normalized tool argument to (stored_at, result). Geocoding results are
+# effectively immutable and current weather changes slowly, so repeat lookups
+# are answered in-process instead of going back to the network.
+_geo_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_weather_cache: "OrderedDict[Tuple[float, float], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def _cache_get(cache: OrderedDict, key, ttl: int) -> Optional[Dict[str, Any]]:
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    stored_at, result = entry
+    if time.monotonic() - stored_at > ttl:
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return dict(result)
+
+def _cache_put(cache: OrderedDict, key, result: Dict[str, Any]) -> None:
+    cache[key] = (time.monotonic(), dict(result))
+    cache.move_to_end(key)
+    while len(cache) > TOOL_RESULT_CACHE_SIZE:
+        cache.popitem(last=False)
 
 # -------------------------
 # City → Coordinates
 # -------------------------
 @mcp.tool()
-def city_to_coords(city: str) -> Dict[str, Any]:
+async def city_to_coords(city: str) -> Dict[str, Any]:
     """Convert city name to latitude and longitude (Open-Meteo Geocoding)."""
-    r = get_with_retry(
+    key = " ".join(city.lower().split())
+    cached = _cache_get(_geo_cache, key, GEOCODING_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    r = await get_with_retry(
         GEOCODING_API_URL,
         params={"name": city, "count": GEOCODING_COUNT},
     )
 
-    results = r.json().get("results")
+    results = _json(r).get("results")
     if not results:
         return {"error": f"No coordinates found for {city}"}
 
     c = results[0]
-    return {
+    result = {
         "city": c.get("name"),
         "country": c.get("country"),
         "latitude": c.get("latitude"),
         "longitude": c.get("longitude"),
     }
+    _cache_put(_geo_cache, key, result)
+    return result
 
 # -------------------------
 # Weather
 # -------------------------
+# Query parameters that never change between calls
+_WEATHER_BASE = {"current": WEATHER_CURRENT_PARAMS, "timezone": WEATHER_TIMEZONE}
+
 @mcp.tool()
-def get_weather(latitude: float, longitude: float) -> Dict[str, Any]:
+async def get_weather(latitude: float, longitude: float) -> Dict[str, Any]:
     """Current weather at coordinates via Open-Meteo."""
-    r = get_with_retry(
+    # ~10 m precision; nearby requests for the same spot share one entry
+    key = (round(latitude, 4), round(longitude, 4))
+    cached = _cache_get(_weather_cache, key, WEATHER_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    r = await get_with_retry(
         WEATHER_API_URL,
-        params={
-            "latitude": latitude,
-            "longitude": longitude,
-            "current": WEATHER_CURRENT_PARAMS,
-            "timezone": WEATHER_TIMEZONE,
-        },
+        params={**_WEATHER_BASE, "latitude": latitude, "longitude": longitude},
     )
-    return r.json().get("current", {})
+    current = _json(r).get("current", {})
+    if current:
+        _cache_put(_weather_cache, key, current)
+    return current
+
+# -------------------------
+# City → Weather (fused)
+# -------------------------
+@mcp.tool()
+async def city_weather(city: str) -> Dict[str, Any]:
+    """Current weather for a city name: geocodes it and fetches weather in one call."""
+    # Saves the agent a full LLM turn versus city_to_coords then get_weather
+    place = await city_to_coords(city)
+    if "error" in place:
+        return place
+    weather = await get_weather(place["latitude"], place["longitude"])
+    return {**place, "weather": weather}
 
 # -------------------------
 # Book Recommendations
 # -------------------------
 @mcp.tool()
-def book_recs(topic: str, limit: int = None) -> Dict[str, Any]:
+async def book_recs(topic: str, limit: int = None) -> Dict[str, Any]:
     """Book recommendations by topic (Google Books API)."""
     if limit is None:
         limit = BOOK_RECS_LIMIT
 
     try:
-        r = get_with_retry(
+        r = await get_with_retry(
             BOOKS_API_URL,
             params={"q": topic, "maxResults": limit},
         )
 
-        data = r.json()
+        data = _json(r)
         
         # Check for API errors
         if "error" in data:
@@ -113,18 +294,16 @@ def book_recs(topic: str, limit: int = None) -> Dict[str, Any]:
                 "message": f"No books found for topic '{topic}'. Try a different search term."
             }
 
-        results: List[Dict[str, Any]] = []
-
-        for item in items[:limit]:
-            info = item.get("volumeInfo", {})
-
-            results.append({
+        results: List[Dict[str, Any]] = [
+            {
                 "title": info.get("title", "Unknown Title"),
                 "authors": info.get("authors", ["Unknown"]),
                 "published_year": info.get("publishedDate", "Unknown"),
                 "description": info.get("description", "No description available"),
                 "preview_link": info.get("previewLink", ""),
-            })
+            }
+            for info in (item.get("volumeInfo", {}) for item in items[:limit])
+        ]
 
         return {
             "topic": topic,
@@ -141,35 +320,50 @@ def book_recs(topic: str, limit: int = None) -> Dict[str, Any]:
 # Dog Image
 # -------------------------
 @mcp.tool()
-def random_dog() -> Dict[str, Any]:
+async def random_dog() -> Dict[str, Any]:
     """Return a random dog image URL."""
-    r = get_with_retry(DOG_API_URL)
-    return r.json()
+    r = await get_with_retry(DOG_API_URL)
+    return _json(r)
 
 # -------------------------
 # Trivia (Optional)
 # -------------------------
+# Open Trivia DB only ever emits a handful of entities; everything else goes
+# through the full html.unescape.
+_ENTITY_RE = re.compile(r"&(amp|quot|#039|lt|gt|apos);")
+_ENTITIES = {"amp": "&", "quot": '"', "#039": "'", "lt": "<", "gt": ">", "apos": "'"}
+
+def _unescape(text: str) -> str:
+    if "&" not in text:
+        return text
+    out = _ENTITY_RE.sub(lambda m: _ENTITIES[m.group(1)], text)
+    if "&" in out:
+        # Deferred: html pulls in the full HTML5 entity table, which only
+        # rare trivia strings need. Unescape the original text so an escaped
+        # ampersand like "&amp;lt;" is not decoded twice.
+        from html import unescape
+        return unescape(text)
+    return out
+
 @mcp.tool()
-def trivia() -> Dict[str, Any]:
+async def trivia() -> Dict[str, Any]:
     """Return one multiple-choice trivia question."""
-    r = get_with_retry(
+    r = await get_with_retry(
         TRIVIA_API_URL,
         params={"amount": TRIVIA_AMOUNT, "type": TRIVIA_TYPE},
     )
 
-    data = r.json().get("results")
+    data = _json(r).get("results")
     if not data:
         return {"error": "No trivia found"}
 
     q = data[0]
     return {
-        "category": q["category"],
+        "category": _unescape(q["category"]),
         "difficulty": q["difficulty"],
-        "question": html.unescape(q["question"]),
-        "correct_answer": html.unescape(q["correct_answer"]),
-        "incorrect_answers": [
-            html.unescape(x) for x in q["incorrect_answers"]
-        ],
+        "question": _unescape(q["question"]),
+        "correct_answer": _unescape(q["correct_answer"]),
+        "incorrect_answers": list(map(_unescape, q["incorrect_answers"])),
     }
 
 # -------------------------